@@ -0,0 +1,162 @@
+# src/backfill.py
+"""
+Bulk import of historical 'CFE Recibidos' exports into the local store.
+
+    python -m src.backfill downloads/ [more dirs or .zip archives] [--workers N] [--db cfe.sqlite3]
+
+Every ExportCFERecibidos-Ruc<RUT>_Periodo-<from>-<to>.xls under the given paths (also inside .zip
+archives) is parsed in a process pool and upserted in large batches. Files are applied oldest period
+first (then by mtime), whatever order the workers finish in, so when exports overlap the newest one
+wins. Files already imported with the same size/mtime are skipped, so an interrupted import resumes
+where it stopped.
+
+Backfill does not write to the change log (src.changefeed). A stored CFE that was last written from a
+more recent download (its source_mtime is later than the file being imported) is never overwritten, so
+backfilling old files cannot silently undo changes the feed has already announced.
+"""
+import argparse
+import os
+import time
+import traceback
+import zipfile
+from datetime import datetime
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from src import config
+from src import store
+from src.cfe_xls import parse_export_filename, read_cfe_rows
+
+# (checkpoint key, file path, zip member or None, size, mtime)
+Task = Tuple[str, str, Optional[str], int, float]
+
+
+def discover(paths: Iterable[str]) -> List[Task]:
+    """
+    Export files under paths. Checkpoint keys are absolute resolved paths (plus '!member' inside zips),
+    the same keys capture_export records, so `downloads` and `./downloads/` never import a file twice.
+    """
+    tasks = []
+    for root in paths:
+        root = Path(root).resolve()
+        candidates = [root] if root.is_file() else sorted(p for p in root.rglob("*") if p.is_file())
+        for p in candidates:
+            p = p.resolve()
+            st = p.stat()
+            if p.suffix.lower() == ".zip":
+                try:
+                    with zipfile.ZipFile(p) as zf:
+                        for info in zf.infolist():
+                            if parse_export_filename(info.filename):
+                                tasks.append((f"{p}!{info.filename}", str(p), info.filename, info.file_size, st.st_mtime))
+                except zipfile.BadZipFile:
+                    print(f"[WARN] Skipping unreadable archive: {p}")
+            elif parse_export_filename(p.name):
+                tasks.append((str(p), str(p), None, st.st_size, st.st_mtime))
+    # overlapping arguments (a directory and a file inside it) name the same file once
+    return list({t[0]: t for t in tasks}.values())
+
+
+def _apply_order(task: Task):
+    key, path, member, size, mtime = task
+    _, period_from, period_to = parse_export_filename(member or path)
+    return period_to, period_from, mtime, key
+
+
+def _parse_task(task: Task):
+    key, path, member, size, mtime = task
+    rut, period_from, period_to = parse_export_filename(member or path)
+    try:
+        if member:
+            with zipfile.ZipFile(path) as zf:
+                rows = read_cfe_rows(file_contents=zf.read(member))
+                # when the export was downloaded, not when it was archived
+                source_mtime = datetime(*zf.getinfo(member).date_time).timestamp()
+        else:
+            rows = read_cfe_rows(path=path)
+            source_mtime = mtime
+        return task, rut, period_from, period_to, source_mtime, rows, None
+    except Exception:
+        return task, rut, period_from, period_to, mtime, [], traceback.format_exc(limit=1)
+
+
+def run_backfill(paths: Iterable[str], db_path: Optional[str] = None, workers: Optional[int] = None, batch_rows: Optional[int] = None) -> dict:
+    workers = workers or config.BACKFILL_WORKERS or os.cpu_count() or 1
+    batch_rows = batch_rows or config.BACKFILL_BATCH_ROWS
+
+    conn = store.connect(db_path)
+    done = store.imported_checkpoints(conn)
+    tasks = discover(paths)
+    todo = sorted((t for t in tasks if done.get(t[0]) != (t[3], t[4])), key=_apply_order)
+    print(f"[BACKFILL] {len(tasks)} export file(s) found, {len(tasks) - len(todo)} already imported, {len(todo)} to import with {workers} worker(s).")
+
+    started = time.perf_counter()
+    last_report = started
+    files = rows_total = errors = 0
+    buffer: List[tuple] = []
+    marks: List[tuple] = []
+
+    def flush():
+        # rows and their file checkpoints commit together, so a crash never marks a half-written file as done
+        with conn:
+            store.upsert_cfe_rows(conn, buffer, keep_newer=True)
+            for mark in marks:
+                store.mark_imported(conn, *mark)
+        buffer.clear()
+        marks.clear()
+
+    try:
+        with Pool(processes=workers) as pool:
+            # imap (not imap_unordered) hands results back in todo order, so overlapping windows are applied
+            # deterministically and a later export's values win over an earlier one's
+            for task, rut, period_from, period_to, source_mtime, rows, error in pool.imap(_parse_task, todo, chunksize=4):
+                key, _, _, size, mtime = task
+                if error:
+                    errors += 1
+                    print(f"[ERROR] Could not parse {key}: {error.strip()}")
+                    continue
+                buffer.extend((rut,) + row + (key, source_mtime) for row in rows)
+                marks.append((key, size, mtime, rut, period_from, period_to, len(rows)))
+                files += 1
+                rows_total += len(rows)
+                if len(buffer) >= batch_rows:
+                    flush()
+
+                now = time.perf_counter()
+                if now - last_report >= 5:
+                    elapsed = now - started
+                    print(f"[BACKFILL] {files}/{len(todo)} files, {rows_total} rows ({files / elapsed:.1f} files/s, {rows_total / elapsed:.0f} rows/s)")
+                    last_report = now
+    finally:
+        if buffer or marks:
+            flush()
+        conn.close()
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    summary = {
+        "files": files,
+        "rows": rows_total,
+        "errors": errors,
+        "skipped": len(tasks) - len(todo),
+        "seconds": round(elapsed, 2),
+        "files_per_s": round(files / elapsed, 1),
+        "rows_per_s": round(rows_total / elapsed, 1),
+    }
+    print(f"[SUCCESS] Backfill imported {files} file(s), {rows_total} row(s) in {elapsed:.1f}s "
+          f"({summary['files_per_s']} files/s, {summary['rows_per_s']} rows/s), {errors} error(s).")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.backfill", description="Import historical CFE XLS exports into the local store")
+    parser.add_argument("paths", nargs="*", default=["downloads"], help="directories, .xls files or .zip archives (default: downloads)")
+    parser.add_argument("--db", default=None, help=f"SQLite store path (default: {config.STORE_PATH})")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: all cores)")
+    parser.add_argument("--batch-rows", type=int, default=None, help=f"rows per insert transaction (default: {config.BACKFILL_BATCH_ROWS})")
+    args = parser.parse_args(argv)
+    run_backfill(args.paths, db_path=args.db, workers=args.workers, batch_rows=args.batch_rows)
+
+
+if __name__ == "__main__":
+    main()
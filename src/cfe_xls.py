@@ -0,0 +1,140 @@
+# src/cfe_xls.py
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+try:
+    import xlrd
+except Exception:
+    xlrd = None
+
+# Filename produced by the portal export saved by export_xls_and_save:
+#   ExportCFERecibidos-Ruc213624850018_Periodo-2025_6_1-2025_6_30.xls
+EXPORT_FILENAME_RE = re.compile(
+    r"ExportCFERecibidos-Ruc(?P<rut>\d+)_Periodo-"
+    r"(?P<y1>\d{4})_(?P<m1>\d{1,2})_(?P<d1>\d{1,2})-"
+    r"(?P<y2>\d{4})_(?P<m2>\d{1,2})_(?P<d2>\d{1,2})"
+    r"(?:\s*\(\d+\))?\.xls$",
+    re.IGNORECASE,
+)
+
+HEADER_FIRST_CELL = "Fecha comprobante"
+# Label of the filter row above the header that names the CFE tipo the export was run for
+TIPO_FILTER_LABEL = "Comprobante"
+
+# Order of values in every parsed row (and of the cfe table columns after rut_receptor)
+CFE_FIELDS = (
+    "fecha",
+    "tipo_cfe",
+    "serie",
+    "numero",
+    "rut_emisor",
+    "moneda",
+    "monto_neto",
+    "iva",
+    "monto_total",
+    "monto_ret",
+    "monto_cred",
+)
+
+
+def parse_export_filename(name: str) -> Optional[Tuple[str, str, str]]:
+    """Return (rut, period_from, period_to) with ISO dates, or None if the name is not a portal export."""
+    m = EXPORT_FILENAME_RE.search(Path(name).name)
+    if not m:
+        return None
+    d_from = f"{int(m['y1']):04d}-{int(m['m1']):02d}-{int(m['d1']):02d}"
+    d_to = f"{int(m['y2']):04d}-{int(m['m2']):02d}-{int(m['d2']):02d}"
+    return m["rut"], d_from, d_to
+
+
+def _iso_date(value) -> str:
+    value = str(value).strip()
+    try:
+        return datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
+    except ValueError:
+        return value
+
+
+def _to_float(value) -> float:
+    if value in ("", None):
+        return 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float(str(value).replace(".", "").replace(",", "."))
+
+
+def _to_number(value):
+    text = str(value).strip()
+    if text.endswith(".0"):
+        text = text[:-2]
+    return int(text) if text.isdigit() else text
+
+
+def read_export_filters(path: Optional[str] = None, file_contents: Optional[bytes] = None) -> dict:
+    """
+    The filter block above the 'Fecha comprobante' header as {label: value}, e.g.
+    {'Comprobante': 'e-Factura', 'Fecha comprobante desde': '01/06/2025', 'Fecha comprobante hasta': '30/06/2025'}.
+    """
+    if xlrd is None:
+        raise RuntimeError("xlrd is not installed; run `pip install xlrd` to read .xls exports.")
+    book = xlrd.open_workbook(filename=path, file_contents=file_contents, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        filters = {}
+        for r in range(sheet.nrows):
+            values = sheet.row_values(r)
+            label = str(values[0]).strip() if values else ""
+            if label == HEADER_FIRST_CELL:
+                break
+            value = str(values[1]).strip() if len(values) > 1 else ""
+            if label and value:
+                filters[label] = value
+        return filters
+    finally:
+        book.release_resources()
+
+
+def read_cfe_rows(path: Optional[str] = None, file_contents: Optional[bytes] = None) -> List[tuple]:
+    """
+    Read the CFE rows of one 'CFE Recibidos' export. Each row is a tuple in CFE_FIELDS order.
+    The sheet starts with a title/filter block; data begins after the 'Fecha comprobante' header row.
+    Raises ValueError if that header row is missing (renamed column, truncated or non-export file), so an
+    unreadable sheet is never mistaken for an export with zero CFEs.
+    """
+    if xlrd is None:
+        raise RuntimeError("xlrd is not installed; run `pip install xlrd` to read .xls exports.")
+    book = xlrd.open_workbook(filename=path, file_contents=file_contents, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        rows = []
+        in_data = False
+        for r in range(sheet.nrows):
+            values = sheet.row_values(r)
+            first = str(values[0]).strip() if values else ""
+            if not in_data:
+                in_data = first == HEADER_FIRST_CELL
+                continue
+            if not first:
+                continue
+            values = list(values) + [""] * (len(CFE_FIELDS) - len(values))
+            rows.append((
+                _iso_date(values[0]),
+                str(values[1]).strip(),
+                str(values[2]).strip(),
+                _to_number(values[3]),
+                str(values[4]).strip(),
+                str(values[5]).strip(),
+                _to_float(values[6]),
+                _to_float(values[7]),
+                _to_float(values[8]),
+                _to_float(values[9]),
+                _to_float(values[10]),
+            ))
+        if not in_data:
+            raise ValueError(f"'{HEADER_FIRST_CELL}' header row not found in {path or 'workbook'}; not a complete CFE Recibidos export")
+        return rows
+    finally:
+        book.release_resources()
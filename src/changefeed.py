@@ -0,0 +1,355 @@
+# src/changefeed.py
+"""
+Change-data-capture for portal exports.
+
+Each downloaded export is diffed against the store for the same receptor RUT, CFE tipo and date
+window: new CFEs become 'insert', changed amounts/currency/date become 'update', and CFEs that were
+stored for that window but are missing from the export become 'delete'. The delta is applied to the
+store and appended to a JSON-lines change log with monotonically increasing offsets.
+
+    python -m src.changefeed capture downloads/ExportCFERecibidos-Ruc..._Periodo-....xls
+    python -m src.changefeed tail --from-offset 120 [--follow]
+
+Delivery is at-least-once: events are appended before the store commit, so a crash in between
+re-emits the same changes on the next run.
+
+Only captured exports produce events. Bulk imports (src.backfill) write the store directly, never
+overwriting a CFE last written from a more recent download, so consumers should treat the store as the
+snapshot of history loaded by backfill and the log as the changes seen by later exports: rows a
+backfill inserts, or refreshes from a newer file than the one they came from, do not appear in the log.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from src import config
+from src import store
+from src.filelock import locked
+from src.cfe_xls import CFE_FIELDS, TIPO_FILTER_LABEL, parse_export_filename, read_cfe_rows, read_export_filters
+
+# Portal labels for the vFILTIPOCFE codes, used to scope 'delete' detection when an export comes back empty
+CFE_TIPO_NAMES = {
+    "101": "e-Ticket",
+    "102": "Nota de Crédito de e-Ticket",
+    "103": "Nota de Débito de e-Ticket",
+    "111": "e-Factura",
+    "112": "Nota de Crédito de e-Factura",
+    "113": "Nota de Débito de e-Factura",
+    "121": "e-Factura de Exportación",
+    "181": "e-Remito",
+    "182": "e-Resguardo",
+}
+
+_capture_lock = threading.Lock()
+
+
+class ChangeLog:
+    """
+    Append-only JSON-lines log. Every event carries an `offset` (0, 1, 2, ...). A sparse sidecar
+    index (<log>.idx, one "offset byte_position" line every CHANGELOG_INDEX_EVERY events) lets
+    readers seek close to their last offset instead of scanning the whole file.
+
+    Writers in different processes (scheduler loop, ad hoc src.main, `changefeed capture`) serialise on
+    an exclusive lock on <log>.lock and read the last offset from the file while holding it.
+    """
+
+    def __init__(self, path: Optional[str] = None, index_every: Optional[int] = None):
+        self.path = Path(path or config.CHANGELOG_PATH)
+        self.index_path = self.path.with_suffix(self.path.suffix + ".idx")
+        self.lock_path = self.path.with_suffix(self.path.suffix + ".lock")
+        self.index_every = max(1, index_every or config.CHANGELOG_INDEX_EVERY)
+        self._lock = threading.Lock()
+        self.next_offset = self._last_offset() + 1
+
+    def _last_offset(self) -> int:
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            return -1
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            chunk = b""
+            # read backwards until a complete line parses as an event
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step) + chunk
+                lines = chunk.split(b"\n")
+                # lines[0] may be cut by the chunk boundary, lines[-1] is a torn tail (or empty)
+                for line in reversed(lines[1:-1] if pos > 0 else lines[:-1]):
+                    try:
+                        return int(json.loads(line)["offset"])
+                    except Exception:
+                        continue
+        return -1
+
+    @staticmethod
+    def _truncate_torn_tail(path: Path) -> int:
+        """Cut an incomplete last line left by a crashed writer. Returns the number of bytes removed."""
+        if not path.exists():
+            return 0
+        with open(path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return 0
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return 0
+            pos = size
+            keep = 0
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                newline = f.read(step).rfind(b"\n")
+                if newline != -1:
+                    keep = pos + newline + 1
+                    break
+            f.truncate(keep)
+            return size - keep
+
+    def append(self, events: List[dict]) -> List[int]:
+        """Assign offsets, append and fsync. Returns the offsets written."""
+        if not events:
+            return []
+        with self._lock, locked(self.lock_path):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            removed = self._truncate_torn_tail(self.path)
+            if removed:
+                print(f"[CDC] Removed {removed} byte(s) of a torn last line from {self.path}")
+            self._truncate_torn_tail(self.index_path)
+            # another process may have appended since we last looked
+            self.next_offset = self._last_offset() + 1
+            offsets = []
+            index_lines = []
+            with open(self.path, "ab") as f:
+                for event in events:
+                    offset = self.next_offset
+                    if offset % self.index_every == 0:
+                        index_lines.append(f"{offset} {f.tell()}\n")
+                    line = json.dumps(dict(event, offset=offset), ensure_ascii=False, default=str)
+                    f.write(line.encode("utf-8") + b"\n")
+                    offsets.append(offset)
+                    self.next_offset += 1
+                f.flush()
+                os.fsync(f.fileno())
+            if index_lines:
+                with open(self.index_path, "a", encoding="utf-8") as idx:
+                    idx.writelines(index_lines)
+            return offsets
+
+    def _seek_position(self, offset: int) -> int:
+        if not self.index_path.exists():
+            return 0
+        best = 0
+        with open(self.index_path, encoding="utf-8") as idx:
+            for line in idx:
+                try:
+                    o, pos = (int(v) for v in line.split())
+                except ValueError:
+                    continue
+                if o > offset:
+                    break
+                best = pos
+        return best
+
+    def read(self, from_offset: int = 0) -> Iterator[dict]:
+        """Yield events with offset >= from_offset. Corrupt lines are reported on stderr and skipped."""
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            pos = self._seek_position(from_offset)
+            if pos > 0:
+                # only trust an index position that lands at the start of a line
+                f.seek(pos - 1)
+                if f.read(1) != b"\n":
+                    pos = 0
+            f.seek(pos)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partially written tail
+                try:
+                    event = json.loads(line)
+                    offset = int(event["offset"])
+                except (ValueError, KeyError, TypeError):
+                    print(f"[CDC] Skipping corrupt line at byte {f.tell() - len(line)} of {self.path}", file=sys.stderr)
+                    continue
+                if offset >= from_offset:
+                    yield event
+
+    def tail(self, from_offset: int = 0, poll_seconds: float = 1.0) -> Iterator[dict]:
+        """Follow the log forever, starting at from_offset."""
+        offset = from_offset
+        while True:
+            for event in self.read(offset):
+                offset = event["offset"] + 1
+                yield event
+            time.sleep(poll_seconds)
+
+
+def _row_dict(columns, values) -> dict:
+    return dict(zip(columns, values))
+
+
+def capture_export(
+    path: str,
+    tipo: Optional[str] = None,
+    db_path: Optional[str] = None,
+    changelog: Optional[ChangeLog] = None,
+    allow_empty_deletes: Optional[bool] = None,
+) -> dict:
+    """
+    Diff one export against the store, append the delta to the change log and apply it.
+    tipo is the vFILTIPOCFE code used for the export. When omitted, the sheet's own 'Comprobante'
+    filter decides (falling back to config.ECF_TIPO); when given, an export whose filter or rows are
+    for a different tipo is refused (ValueError, nothing written) so a mislabelled file never deletes
+    another tipo's CFEs.
+    An export with no rows that would delete stored CFEs is refused (ValueError, nothing written)
+    unless allow_empty_deletes / CDC_ALLOW_EMPTY_EXPORT_DELETES says the portal really emptied the window.
+    Returns counts per operation.
+    """
+    if allow_empty_deletes is None:
+        allow_empty_deletes = config.CDC_ALLOW_EMPTY_EXPORT_DELETES
+    parsed = parse_export_filename(path)
+    if not parsed:
+        raise ValueError(f"Not a portal export filename: {path}")
+    rut, period_from, period_to = parsed
+    rows = read_cfe_rows(path=path)
+    sheet_tipo = read_export_filters(path=path).get(TIPO_FILTER_LABEL)
+    # same checkpoint key as src.backfill.discover
+    source = str(Path(path).resolve())
+    st = Path(path).stat()
+
+    if tipo is None and sheet_tipo:
+        # a filter that is not a single known tipo (e.g. all tipos) leaves the scope to the rows
+        tipo_name = sheet_tipo if sheet_tipo in CFE_TIPO_NAMES.values() else None
+    else:
+        tipo = tipo or config.ECF_TIPO
+        tipo_name = CFE_TIPO_NAMES.get(tipo)
+    row_tipos = {r[CFE_FIELDS.index("tipo_cfe")] for r in rows}
+    if tipo_name:
+        found = row_tipos | ({sheet_tipo} if sheet_tipo else set())
+        if found - {tipo_name}:
+            raise ValueError(
+                f"{path} is an export of {sorted(found)}, not {tipo_name}; refusing to diff it "
+                f"against the wrong CFE tipo. Pass the tipo the export was run with."
+            )
+    scope = row_tipos | ({tipo_name} if tipo_name else set())
+
+    key_idx = [store.CFE_COLUMNS.index(c) for c in store.CFE_KEY]
+    value_idx = [store.CFE_COLUMNS.index(c) for c in store.CFE_VALUE_COLUMNS]
+    incoming = {}
+    for row in rows:
+        full = (rut,) + row + (source, st.st_mtime)
+        incoming[tuple(full[i] for i in key_idx)] = full
+
+    run_id = f"{int(time.time() * 1000)}-{Path(path).name}"
+    changelog = changelog or ChangeLog()
+
+    with _capture_lock:
+        conn = store.connect(db_path)
+        try:
+            existing = {}
+            if scope:
+                placeholders = ", ".join("?" for _ in scope)
+                cur = conn.execute(
+                    f"SELECT {', '.join(store.CFE_COLUMNS)} FROM cfe "
+                    f"WHERE rut_receptor = ? AND tipo_cfe IN ({placeholders}) AND fecha BETWEEN ? AND ?",
+                    (rut, *sorted(scope), period_from, period_to),
+                )
+                for r in cur:
+                    existing[tuple(r[i] for i in key_idx)] = r
+            else:
+                print(f"[CDC] Unknown tipo '{tipo}' and empty export; deletions cannot be scoped for {path}")
+
+            # CFEs stored outside this window (e.g. a corrected fecha) are still matched by primary key
+            where_key = " AND ".join(f"{c} = ?" for c in store.CFE_KEY)
+            for key in incoming.keys() - existing.keys():
+                r = conn.execute(f"SELECT {', '.join(store.CFE_COLUMNS)} FROM cfe WHERE {where_key}", key).fetchone()
+                if r:
+                    existing[key] = r
+
+            events, upserts, unchanged, deletes = [], [], [], []
+            base = {"run_id": run_id, "ts": time.time(), "rut_receptor": rut, "period_from": period_from, "period_to": period_to}
+            for key, new in incoming.items():
+                old = existing.get(key)
+                key_dict = _row_dict(store.CFE_KEY, key)
+                if old is None:
+                    events.append(dict(base, op="insert", tipo_cfe=key_dict["tipo_cfe"], key=key_dict,
+                                       before=None, after=_row_dict(store.CFE_VALUE_COLUMNS, [new[i] for i in value_idx])))
+                    upserts.append(new)
+                    continue
+                changed = [c for c, i in zip(store.CFE_VALUE_COLUMNS, value_idx) if old[i] != new[i]]
+                if changed:
+                    events.append(dict(base, op="update", tipo_cfe=key_dict["tipo_cfe"], key=key_dict, changed=changed,
+                                       before=_row_dict(store.CFE_VALUE_COLUMNS, [old[i] for i in value_idx]),
+                                       after=_row_dict(store.CFE_VALUE_COLUMNS, [new[i] for i in value_idx])))
+                    upserts.append(new)
+                else:
+                    unchanged.append(key)
+            for key, old in existing.items():
+                if key in incoming:
+                    continue
+                key_dict = _row_dict(store.CFE_KEY, key)
+                events.append(dict(base, op="delete", tipo_cfe=key_dict["tipo_cfe"], key=key_dict,
+                                   before=_row_dict(store.CFE_VALUE_COLUMNS, [old[i] for i in value_idx]), after=None))
+                deletes.append(key)
+
+            if not rows and deletes and not allow_empty_deletes:
+                raise ValueError(
+                    f"{path} has no CFE rows but would delete {len(deletes)} stored CFE(s) for {rut} "
+                    f"{period_from}..{period_to}; refusing. Re-run with --allow-empty-deletes if this is intended."
+                )
+
+            offsets = changelog.append(events)
+            with conn:
+                store.upsert_cfe_rows(conn, upserts)
+                store.mark_cfe_source(conn, unchanged, source, st.st_mtime)
+                store.delete_cfe_keys(conn, deletes)
+                store.mark_imported(conn, source, st.st_size, st.st_mtime, rut, period_from, period_to, len(rows))
+        finally:
+            conn.close()
+
+    counts = {op: sum(1 for e in events if e["op"] == op) for op in ("insert", "update", "delete")}
+    span = f"offsets {offsets[0]}..{offsets[-1]}" if offsets else "no changes"
+    print(f"[CDC] {Path(path).name}: {len(rows)} rows, +{counts['insert']} ~{counts['update']} -{counts['delete']} ({span})")
+    return dict(counts, rows=len(rows), offsets=offsets)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.changefeed", description="CFE change log")
+    parser.add_argument("--log", default=None, help=f"change log path (default: {config.CHANGELOG_PATH})")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_cap = sub.add_parser("capture", help="diff exports against the store and append their changes")
+    p_cap.add_argument("files", nargs="+")
+    p_cap.add_argument("--tipo", default=None, help="vFILTIPOCFE code used for the export (default: the sheet's Comprobante filter)")
+    p_cap.add_argument("--db", default=None)
+    p_cap.add_argument("--allow-empty-deletes", action="store_true", help="accept an empty export that deletes stored CFEs")
+
+    p_tail = sub.add_parser("tail", help="print events from an offset")
+    p_tail.add_argument("--from-offset", type=int, default=0)
+    p_tail.add_argument("--follow", action="store_true")
+
+    args = parser.parse_args(argv)
+    log = ChangeLog(args.log)
+    if args.cmd == "capture":
+        for f in args.files:
+            capture_export(f, tipo=args.tipo, db_path=args.db, changelog=log, allow_empty_deletes=args.allow_empty_deletes or None)
+    elif args.cmd == "tail":
+        events = log.tail(args.from_offset) if args.follow else log.read(args.from_offset)
+        try:
+            for event in events:
+                print(json.dumps(event, ensure_ascii=False, default=str), flush=True)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# src/concurrency.py
+import json
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from playwright.sync_api import TimeoutError
+from src import config
+
+
+class _StepTimer:
+    """Handle yielded by AdaptiveConcurrencyController.step(); set timed_out=True to flag a soft failure."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timed_out = False
+        self.latency_ms = 0.0
+
+
+class AdaptiveConcurrencyController:
+    """
+    AIMD limiter for the number of browser contexts talking to the DGI portal at once.
+
+    Every session step (login, consult, export) reports its latency and whether it timed out.
+    Once `window` samples have been collected the controller decides:
+      - timeout rate above max_timeout_rate, or mean latency above target -> multiplicative decrease
+      - otherwise, if all slots are in use                               -> additive increase (+1)
+    The limit always stays within [min_limit, max_limit]. Each change is kept with its reason
+    and exposed through metrics() / the optional JSON metrics file.
+    """
+
+    def __init__(
+        self,
+        min_limit: Optional[int] = None,
+        max_limit: Optional[int] = None,
+        initial_limit: Optional[int] = None,
+        target_latency_ms: Optional[float] = None,
+        max_timeout_rate: Optional[float] = None,
+        window: Optional[int] = None,
+        backoff: float = 0.5,
+        metrics_path: Optional[str] = None,
+        observer: Optional[Callable[[str, float, bool], None]] = None,
+    ):
+        self.min_limit = max(1, min_limit if min_limit is not None else config.CONCURRENCY_MIN)
+        self.max_limit = max(self.min_limit, max_limit if max_limit is not None else config.CONCURRENCY_MAX)
+        start = initial_limit if initial_limit is not None else self.min_limit
+        self.limit = min(self.max_limit, max(self.min_limit, start))
+        self.target_latency_ms = target_latency_ms if target_latency_ms is not None else config.CONCURRENCY_TARGET_LATENCY_MS
+        self.max_timeout_rate = max_timeout_rate if max_timeout_rate is not None else config.CONCURRENCY_MAX_TIMEOUT_RATE
+        self.window = max(1, window if window is not None else config.CONCURRENCY_WINDOW)
+        self.backoff = backoff
+        self.metrics_path = metrics_path if metrics_path is not None else config.CONCURRENCY_METRICS_PATH
+        self.observer = observer
+
+        self._cond = threading.Condition()
+        self._metrics_lock = threading.Lock()
+        self.active = 0
+        self.sessions_started = 0
+        self._samples = deque()
+        self._saturated = False
+        self._steps: Dict[str, Dict[str, float]] = {}
+        self.changes: List[dict] = []
+
+    # ---------------------------
+    # Session slots
+    # ---------------------------
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.active >= self.limit:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 1.0)
+            self.active += 1
+            return True
+
+    def session_started(self):
+        """
+        Call once a held slot actually has work to do. Slots acquired by a worker that then finds the
+        job queue empty are not counted, and do not mark the pool as saturated.
+        """
+        with self._cond:
+            self.sessions_started += 1
+            if self.active >= self.limit:
+                self._saturated = True
+
+    def release(self):
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            self._cond.notify_all()
+
+    @contextmanager
+    def session(self):
+        self.acquire()
+        self.session_started()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    # ---------------------------
+    # Step measurements
+    # ---------------------------
+
+    @contextmanager
+    def step(self, name: str):
+        """
+        Time one session step. Playwright TimeoutError marks the sample as timed out and is re-raised;
+        callers whose helpers swallow timeouts (e.g. export_xls_and_save returning None) set timer.timed_out.
+        """
+        timer = _StepTimer(name)
+        started = time.perf_counter()
+        try:
+            yield timer
+        except TimeoutError:
+            timer.timed_out = True
+            raise
+        finally:
+            timer.latency_ms = (time.perf_counter() - started) * 1000.0
+            self.record(name, timer.latency_ms, timer.timed_out)
+
+    def record(self, step: str, latency_ms: float, timed_out: bool = False):
+        with self._cond:
+            stats = self._steps.setdefault(step, {"count": 0, "timeouts": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0})
+            stats["count"] += 1
+            stats["timeouts"] += 1 if timed_out else 0
+            stats["total_ms"] += latency_ms
+            stats["max_ms"] = max(stats["max_ms"], latency_ms)
+            stats["last_ms"] = latency_ms
+
+            self._samples.append((latency_ms, timed_out))
+            if len(self._samples) >= self.window:
+                self._adjust()
+        if self.observer:
+            try:
+                self.observer(step, latency_ms, timed_out)
+            except Exception as e:
+                print("[CONCURRENCY] observer failed:", e)
+        self._write_metrics()
+
+    def _adjust(self):
+        # called with self._cond held
+        samples = list(self._samples)
+        self._samples.clear()
+        timeout_rate = sum(1 for _, t in samples if t) / len(samples)
+        mean_ms = sum(ms for ms, _ in samples) / len(samples)
+        old = self.limit
+
+        if timeout_rate > self.max_timeout_rate:
+            new = max(self.min_limit, int(math.floor(old * self.backoff)))
+            reason = f"timeout rate {timeout_rate:.0%} > {self.max_timeout_rate:.0%}"
+        elif mean_ms > self.target_latency_ms:
+            new = max(self.min_limit, int(math.floor(old * self.backoff)))
+            reason = f"mean step latency {mean_ms:.0f}ms > target {self.target_latency_ms:.0f}ms"
+        elif self._saturated:
+            new = min(self.max_limit, old + 1)
+            reason = f"healthy at saturation (mean {mean_ms:.0f}ms, timeouts {timeout_rate:.0%})"
+        else:
+            new = old
+            reason = "healthy but not saturated"
+
+        self._saturated = self.active >= max(new, 1)
+        if new != old:
+            self.limit = new
+            change = {
+                "ts": time.time(),
+                "from": old,
+                "to": new,
+                "reason": reason,
+                "mean_latency_ms": round(mean_ms, 1),
+                "timeout_rate": round(timeout_rate, 3),
+            }
+            self.changes.append(change)
+            print(f"[CONCURRENCY] limit {old} -> {new}: {reason}")
+            self._cond.notify_all()
+
+    # ---------------------------
+    # Metrics
+    # ---------------------------
+
+    def metrics(self) -> dict:
+        with self._cond:
+            steps = {}
+            for name, s in self._steps.items():
+                steps[name] = {
+                    "count": int(s["count"]),
+                    "timeouts": int(s["timeouts"]),
+                    "timeout_rate": round(s["timeouts"] / s["count"], 3) if s["count"] else 0.0,
+                    "avg_ms": round(s["total_ms"] / s["count"], 1) if s["count"] else 0.0,
+                    "max_ms": round(s["max_ms"], 1),
+                    "last_ms": round(s["last_ms"], 1),
+                }
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "sessions_started": self.sessions_started,
+                "steps": steps,
+                "last_change": self.changes[-1] if self.changes else None,
+                "changes": list(self.changes[-50:]),
+            }
+
+    def _write_metrics(self):
+        if not self.metrics_path:
+            return
+        try:
+            path = Path(self.metrics_path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(path.suffix + ".tmp")
+            with self._metrics_lock:
+                tmp.write_text(json.dumps(self.metrics(), indent=2), encoding="utf-8")
+                tmp.replace(path)
+        except Exception as e:
+            print("[CONCURRENCY] Could not write metrics file:", e)
@@ -1,5 +1,6 @@
 # src/config.py
 import os
+import sys
 from pathlib import Path
 
 try:
@@ -13,21 +14,22 @@ def _load_dotenv_verbose():
         env_path = find_dotenv(raise_error_if_not_found=False)
         if env_path:
             loaded = load_dotenv(env_path, override=False)
-            print(f"[CONFIG] Loaded .env from: {env_path} (loaded={loaded})")
+            print(f"[CONFIG] Loaded .env from: {env_path} (loaded={loaded})", file=sys.stderr)
             return Path(env_path)
         else:
             here = Path(__file__).resolve().parent.parent
             candidate = here / ".env"
             if candidate.exists():
                 loaded = load_dotenv(str(candidate), override=False)
-                print(f"[CONFIG] Loaded .env from project root: {candidate} (loaded={loaded})")
+                print(f"[CONFIG] Loaded .env from project root: {candidate} (loaded={loaded})", file=sys.stderr)
                 return candidate
-            print("[CONFIG] No .env found by dotenv. Continuing — environment variables may be empty.")
+            print("[CONFIG] No .env found by dotenv. Continuing — environment variables may be empty.", file=sys.stderr)
             return None
     else:
-        print("[CONFIG] python-dotenv not installed or not available. Relying on actual environment variables.")
+        print("[CONFIG] python-dotenv not installed or not available. Relying on actual environment variables.", file=sys.stderr)
         return None
 
+# config diagnostics go to stderr so JSON-printing CLIs (src.query, src.changefeed tail) keep stdout clean
 _env_path = _load_dotenv_verbose()
 
 RUT = os.environ.get("RUT", "").strip()
@@ -46,8 +48,57 @@ def _to_int_env(key, default):
         except Exception:
             return 60000
 
+def _to_float_env(key, default):
+    try:
+        return float(os.environ.get(key, default))
+    except Exception:
+        return float(default)
+
 GOTO_TIMEOUT = _to_int_env("GOTO_TIMEOUT_MS", 120000)
 LOADSTATE_TIMEOUT = _to_int_env("LOADSTATE_TIMEOUT_MS", 60000)
 
-print("[CONFIG] RUT (repr):", repr(RUT))
-print("[CONFIG] CLAVE (repr):", repr(CLAVE))
+HEADLESS = os.environ.get("HEADLESS", "false").strip().lower() in ("1", "true", "yes")
+
+# Split the ECF_FROM_DATE..ECF_TO_DATE window into chunks of N days (0 = single window)
+ECF_SPLIT_DAYS = _to_int_env("ECF_SPLIT_DAYS", 0)
+
+# Adaptive concurrency (number of browser contexts open against the portal at once)
+CONCURRENCY_MIN = _to_int_env("CONCURRENCY_MIN", 1)
+CONCURRENCY_MAX = _to_int_env("CONCURRENCY_MAX", 4)
+CONCURRENCY_TARGET_LATENCY_MS = _to_float_env("CONCURRENCY_TARGET_LATENCY_MS", 30000)
+CONCURRENCY_MAX_TIMEOUT_RATE = _to_float_env("CONCURRENCY_MAX_TIMEOUT_RATE", 0.1)
+CONCURRENCY_WINDOW = _to_int_env("CONCURRENCY_WINDOW", 6)
+CONCURRENCY_METRICS_PATH = os.environ.get("CONCURRENCY_METRICS_PATH", "concurrency_metrics.json").strip()
+
+# Export scheduler (src/scheduler.py)
+SCHEDULER_STATE_PATH = os.environ.get("SCHEDULER_STATE_PATH", "scheduler_state.json").strip()
+SCHEDULER_POLL_SECONDS = _to_int_env("SCHEDULER_POLL_SECONDS", 900)
+SCHEDULER_BATCH_SIZE = _to_int_env("SCHEDULER_BATCH_SIZE", 8)
+SCHEDULER_MAX_ATTEMPTS = _to_int_env("SCHEDULER_MAX_ATTEMPTS", 3)
+SCHEDULER_MIN_SAMPLES = _to_int_env("SCHEDULER_MIN_SAMPLES", 3)
+SCHEDULER_FAST_QUANTILE = _to_float_env("SCHEDULER_FAST_QUANTILE", 0.5)
+SCHEDULER_STALE_RUNNING_HOURS = _to_float_env("SCHEDULER_STALE_RUNNING_HOURS", 6)
+SCHEDULER_DEFAULT_DEADLINE_HOURS = {
+    "urgent": _to_float_env("SCHEDULER_URGENT_DEADLINE_HOURS", 4),
+    "normal": _to_float_env("SCHEDULER_NORMAL_DEADLINE_HOURS", 24),
+    "backfill": _to_float_env("SCHEDULER_BACKFILL_DEADLINE_HOURS", 24 * 14),
+}
+
+# Local CFE store (src/store.py) and bulk importer (src/backfill.py)
+STORE_PATH = os.environ.get("STORE_PATH", "cfe.sqlite3").strip()
+BACKFILL_WORKERS = _to_int_env("BACKFILL_WORKERS", 0)  # 0 = all cores
+BACKFILL_BATCH_ROWS = _to_int_env("BACKFILL_BATCH_ROWS", 50000)
+
+# Query API over the store (src/query.py)
+QUERY_CACHE_SIZE = _to_int_env("QUERY_CACHE_SIZE", 10000)
+QUERY_HTTP_PORT = _to_int_env("QUERY_HTTP_PORT", 8765)
+
+# Change-data-capture of every export into an append-only change log (src/changefeed.py)
+CDC_ENABLED = os.environ.get("CDC_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+CHANGELOG_PATH = os.environ.get("CHANGELOG_PATH", "changes.jsonl").strip()
+CHANGELOG_INDEX_EVERY = _to_int_env("CHANGELOG_INDEX_EVERY", 1000)
+# An export with zero rows never deletes stored CFEs unless this is set
+CDC_ALLOW_EMPTY_EXPORT_DELETES = os.environ.get("CDC_ALLOW_EMPTY_EXPORT_DELETES", "false").strip().lower() in ("1", "true", "yes")
+
+print("[CONFIG] RUT (repr):", repr(RUT), file=sys.stderr)
+print("[CONFIG] CLAVE (repr):", repr(CLAVE), file=sys.stderr)
@@ -1,24 +1,46 @@
 # src/main.py
+import queue
+import threading
 import time
+from datetime import datetime, timedelta
 from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
 from playwright.sync_api import sync_playwright
 from src.auth import login_and_continue, fill_cfe_and_consult, export_xls_and_save
+from src.changefeed import capture_export
+from src.concurrency import AdaptiveConcurrencyController
 from src import config
 
 START_URL = "https://servicios.dgi.gub.uy/serviciosenlinea"
+DATE_FMT = "%d/%m/%Y"
 
-def main():
-    print("[CONFIG] LOGIN START URL:", START_URL)
-    print("[CONFIG] GOTO_TIMEOUT (ms):", config.GOTO_TIMEOUT)
-    print("[CONFIG] RUT (repr):", repr(config.RUT))
-    print("[CONFIG] CLAVE (repr):", repr(config.CLAVE))
 
-    with sync_playwright() as pw:
-        browser = pw.chromium.launch(headless=False)
-        context = browser.new_context(accept_downloads=True, ignore_https_errors=True)
-        page = context.new_page()
+class ExportJob(NamedTuple):
+    tipo: str
+    date_from: str
+    date_to: str
+
+
+def split_windows(date_from: str, date_to: str, days: int) -> List[Tuple[str, str]]:
+    """Split a DD/MM/YYYY window into consecutive chunks of `days` days (days <= 0 keeps it whole)."""
+    if days <= 0:
+        return [(date_from, date_to)]
+    start = datetime.strptime(date_from, DATE_FMT)
+    end = datetime.strptime(date_to, DATE_FMT)
+    windows = []
+    while start <= end:
+        chunk_end = min(end, start + timedelta(days=days - 1))
+        windows.append((start.strftime(DATE_FMT), chunk_end.strftime(DATE_FMT)))
+        start = chunk_end + timedelta(days=1)
+    return windows
 
-        print("[INFO] Opening page...")
+
+def run_export(context, job: ExportJob, controller: AdaptiveConcurrencyController, save_dir: str) -> Optional[str]:
+    """Run one full portal session (login -> consult -> export) inside an already opened browser context."""
+    page = context.new_page()
+
+    print(f"[INFO] Opening page for {job.tipo} {job.date_from}..{job.date_to}...")
+    with controller.step("goto"):
         try:
             page.goto(START_URL, wait_until="load", timeout=config.GOTO_TIMEOUT)
         except Exception:
@@ -27,27 +49,135 @@ def main():
             except Exception as e:
                 print("[WARN] Could not fully navigate to start URL:", e)
 
-        # 1) Login + Continue + Nav to "Consulta de CFE recibidos"
+    # 1) Login + Continue + Nav to "Consulta de CFE recibidos"
+    with controller.step("login"):
         page_obj, url = login_and_continue(page, post_click_wait=5)
-        print("[INFO] Landed at:", url)
+    print("[INFO] Landed at:", url)
 
-        # 2) Fill CFE filters and click Consultar (values from .env/config)
-        final_page, result_url = fill_cfe_and_consult(page_obj)
-        print("[INFO] After consult, landed at:", result_url)
+    # 2) Fill CFE filters and click Consultar
+    with controller.step("consult"):
+        final_page, result_url = fill_cfe_and_consult(page_obj, tipo_value=job.tipo, date_from=job.date_from, date_to=job.date_to)
+    print("[INFO] After consult, landed at:", result_url)
 
-        # 3) Export XLS by clicking the highlighted control and save it
-        downloads_dir = Path.cwd() / "downloads"
-        saved_path = export_xls_and_save(final_page, save_dir=str(downloads_dir), timeout=30000)
-        if saved_path:
-            print(f"[INFO] Export saved to: {saved_path}")
-        else:
-            print("[ERROR] Export failed or file not found.")
+    # 3) Export XLS by clicking the highlighted control and save it
+    with controller.step("export") as step:
+        # the portal names the file after RUT and period only, so concurrent jobs for different tipos
+        # over the same window would overwrite each other's download without a per-tipo directory
+        saved_path = export_xls_and_save(final_page, save_dir=str(Path(save_dir) / f"tipo_{job.tipo}"), timeout=30000)
+        if not saved_path:
+            step.timed_out = True
+
+    # 4) Record what changed since the previous export of this window
+    if saved_path and config.CDC_ENABLED:
+        try:
+            capture_export(saved_path, tipo=job.tipo)
+        except Exception as e:
+            print("[WARN] Change capture failed for", saved_path, ":", e)
+    return saved_path
 
-        print("[INFO] Done. Keeping browser open for 5 seconds to inspect...")
-        time.sleep(5)
 
-        context.close()
-        browser.close()
+def _export_worker(jobs: "queue.Queue[ExportJob]", controller: AdaptiveConcurrencyController, results: list, save_dir: str, linger: int):
+    # The sync API is bound to the thread that started it, so every worker owns its playwright/browser.
+    with sync_playwright() as pw:
+        browser = None
+        try:
+            while True:
+                controller.acquire()
+                try:
+                    try:
+                        job = jobs.get_nowait()
+                    except queue.Empty:
+                        return
+                    controller.session_started()
+                    context = None
+                    saved_path = None
+                    try:
+                        if browser is None:
+                            browser = pw.chromium.launch(headless=config.HEADLESS)
+                        context = browser.new_context(accept_downloads=True, ignore_https_errors=True)
+                        saved_path = run_export(context, job, controller, save_dir)
+                    except Exception as e:
+                        print(f"[ERROR] Export session failed for {job}:", e)
+                        if browser is not None and not browser.is_connected():
+                            browser = None  # relaunch on the next job
+                    if saved_path:
+                        print(f"[INFO] Export saved to: {saved_path}")
+                    else:
+                        print(f"[ERROR] Export failed or file not found for {job}.")
+                    results.append((job, saved_path))
+                    if context is not None:
+                        if linger:
+                            print(f"[INFO] Done. Keeping browser open for {linger} seconds to inspect...")
+                            time.sleep(linger)
+                        try:
+                            context.close()
+                        except Exception:
+                            pass
+                finally:
+                    controller.release()
+        finally:
+            if browser is not None:
+                try:
+                    browser.close()
+                except Exception:
+                    pass
+
+
+def run_exports(
+    jobs: List[ExportJob],
+    controller: Optional[AdaptiveConcurrencyController] = None,
+    save_dir: Optional[str] = None,
+) -> List[Tuple[ExportJob, Optional[str]]]:
+    """
+    Run export jobs on up to controller.max_limit worker threads. The controller decides how many
+    browser contexts are active at any moment and adapts that number to observed portal latency.
+    """
+    controller = controller or AdaptiveConcurrencyController()
+    save_dir = save_dir or str(Path.cwd() / "downloads")
+
+    pending: "queue.Queue[ExportJob]" = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+
+    linger = 5 if len(jobs) == 1 and not config.HEADLESS else 0
+    results: list = []
+    workers = [
+        threading.Thread(target=_export_worker, args=(pending, controller, results, save_dir, linger), name=f"export-{i}", daemon=True)
+        for i in range(max(1, min(controller.max_limit, len(jobs))))
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    # jobs left behind by workers that died before taking them (e.g. playwright failed to start)
+    while True:
+        try:
+            job = pending.get_nowait()
+        except queue.Empty:
+            break
+        print(f"[ERROR] No worker ran {job}; recording it as failed.")
+        results.append((job, None))
+
+    m = controller.metrics()
+    print(f"[CONCURRENCY] Final limit={m['limit']} sessions={m['sessions_started']} changes={len(m['changes'])}")
+    for name, s in m["steps"].items():
+        print(f"[CONCURRENCY]   {name}: n={s['count']} avg={s['avg_ms']}ms max={s['max_ms']}ms timeouts={s['timeouts']}")
+    return results
+
+
+def main():
+    print("[CONFIG] LOGIN START URL:", START_URL)
+    print("[CONFIG] GOTO_TIMEOUT (ms):", config.GOTO_TIMEOUT)
+    print("[CONFIG] RUT (repr):", repr(config.RUT))
+    print("[CONFIG] CLAVE (repr):", repr(config.CLAVE))
+    print(f"[CONFIG] Concurrency bounds: {config.CONCURRENCY_MIN}..{config.CONCURRENCY_MAX}")
+
+    jobs = [
+        ExportJob(config.ECF_TIPO, d_from, d_to)
+        for d_from, d_to in split_windows(config.ECF_FROM_DATE, config.ECF_TO_DATE, config.ECF_SPLIT_DAYS)
+    ]
+    run_exports(jobs)
 
 if __name__ == "__main__":
     main()
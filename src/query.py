@@ -0,0 +1,237 @@
+# src/query.py
+"""
+Indexed lookups and aggregations over the local CFE store (filled by src.backfill).
+
+    python -m src.query lookup --emisor 214149680018 --serie A --numero 494760
+    python -m src.query totals --month 2025-06 [--emisor RUT] [--by emisor]
+    python -m src.query range --from 2025-06-01 --to 2025-06-15 [--emisor RUT] [--tipo e-Factura]
+    python -m src.query serve [--host 127.0.0.1] [--port 8765]
+
+HTTP endpoints (JSON): /cfe?emisor=&serie=&numero=[&tipo=&receptor=], /totals?month=[&emisor=&by=],
+/range?from=&to=[&emisor=&tipo=&receptor=], /stats
+"""
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from src import config
+from src import store
+
+AMOUNT_COLUMNS = ("monto_neto", "iva", "monto_total")
+
+
+class CfeQuery:
+    """
+    Read API over the store. Point lookups go through an LRU cache that is dropped whenever another
+    connection commits (PRAGMA data_version changes), so imports are visible immediately.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, cache_size: Optional[int] = None):
+        # shared across HTTP handler threads; every access goes through self._lock
+        self.conn = store.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.cache_size = cache_size if cache_size is not None else config.QUERY_CACHE_SIZE
+        self._cache: "OrderedDict[tuple, list]" = OrderedDict()
+        self._data_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self):
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._cache.clear()
+            self._data_version = version
+
+    def _cached(self, key: tuple, sql: str, params: tuple) -> List[dict]:
+        with self._lock:
+            self._check_version()
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            rows = [dict(r) for r in self.conn.execute(sql, params)]
+            if self.cache_size > 0:
+                self._cache[key] = rows
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return rows
+
+    def _query(self, sql: str, params: tuple) -> List[dict]:
+        with self._lock:
+            return [dict(r) for r in self.conn.execute(sql, params)]
+
+    # ---------------------------
+    # Lookups
+    # ---------------------------
+
+    def lookup(self, emisor: str, serie: str, numero: int, tipo: Optional[str] = None, receptor: Optional[str] = None) -> List[dict]:
+        """CFEs with this issuer/series/number (normally one; several only across tipos or receptors)."""
+        sql = "SELECT * FROM cfe WHERE rut_emisor = ? AND serie = ? AND numero = ?"
+        params = [emisor, serie, int(numero)]
+        if tipo:
+            sql += " AND tipo_cfe = ?"
+            params.append(tipo)
+        if receptor:
+            sql += " AND rut_receptor = ?"
+            params.append(receptor)
+        return self._cached(("lookup", emisor, serie, int(numero), tipo, receptor), sql, tuple(params))
+
+    def exists(self, emisor: str, serie: str, numero: int, tipo: Optional[str] = None) -> bool:
+        return bool(self.lookup(emisor, serie, numero, tipo=tipo))
+
+    # ---------------------------
+    # Aggregations
+    # ---------------------------
+
+    def totals(self, month: Optional[str] = None, emisor: Optional[str] = None, receptor: Optional[str] = None, by: Optional[str] = None) -> List[dict]:
+        """
+        Totals per currency from the precomputed cfe_agg table. by: None, 'emisor', 'month' or 'tipo'.
+        month is YYYY-MM.
+        """
+        group_cols = {None: (), "emisor": ("rut_emisor",), "month": ("month",), "tipo": ("tipo_cfe",)}[by]
+        where, params = [], []
+        for col, value in (("month", month), ("rut_emisor", emisor), ("rut_receptor", receptor)):
+            if value:
+                where.append(f"{col} = ?")
+                params.append(value)
+        select = ", ".join(
+            group_cols + ("moneda", "SUM(n) AS n") + tuple(f"SUM({c}_cents) / 100.0 AS {c}" for c in AMOUNT_COLUMNS)
+        )
+        sql = f"SELECT {select} FROM cfe_agg"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY " + ", ".join(group_cols + ("moneda",))
+        sql += " ORDER BY monto_total DESC"
+        return self._cached(("totals", month, emisor, receptor, by), sql, tuple(params))
+
+    def range_totals(self, date_from: str, date_to: str, emisor: Optional[str] = None, tipo: Optional[str] = None, receptor: Optional[str] = None) -> List[dict]:
+        """
+        Totals per currency for an arbitrary ISO date range (uses the fecha indexes on cfe). Sums are taken
+        in integer cents, like cfe_agg, so both APIs return identical amounts for the same rows.
+        """
+        where, params = ["fecha BETWEEN ? AND ?"], [date_from, date_to]
+        for col, value in (("rut_emisor", emisor), ("tipo_cfe", tipo), ("rut_receptor", receptor)):
+            if value:
+                where.append(f"{col} = ?")
+                params.append(value)
+        sql = (
+            "SELECT moneda, COUNT(*) AS n, "
+            + ", ".join(f"SUM(CAST(ROUND({c} * 100) AS INTEGER)) / 100.0 AS {c}" for c in AMOUNT_COLUMNS)
+            + f" FROM cfe WHERE {' AND '.join(where)} GROUP BY moneda ORDER BY monto_total DESC"
+        )
+        return self._query(sql, tuple(params))
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self.conn.execute("SELECT COUNT(*) FROM cfe").fetchone()[0]
+        return {"rows": rows, "cache_entries": len(self._cache), "cache_hits": self.hits, "cache_misses": self.misses}
+
+
+# ---------------------------
+# HTTP interface
+# ---------------------------
+
+def _make_handler(q: CfeQuery):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, payload):
+            body = json.dumps(payload, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            p = {k: v[0] for k, v in parse_qs(url.query).items()}
+            started = time.perf_counter()
+            try:
+                if url.path == "/cfe":
+                    result = q.lookup(p["emisor"], p["serie"], int(p["numero"]), tipo=p.get("tipo"), receptor=p.get("receptor"))
+                elif url.path == "/totals":
+                    result = q.totals(month=p.get("month"), emisor=p.get("emisor"), receptor=p.get("receptor"), by=p.get("by"))
+                elif url.path == "/range":
+                    result = q.range_totals(p["from"], p["to"], emisor=p.get("emisor"), tipo=p.get("tipo"), receptor=p.get("receptor"))
+                elif url.path == "/stats":
+                    result = q.stats()
+                else:
+                    return self._send(404, {"error": f"unknown path {url.path}"})
+            except (KeyError, ValueError) as e:
+                return self._send(400, {"error": f"bad or missing parameter: {e}"})
+            self._send(200, {"result": result, "elapsed_ms": round((time.perf_counter() - started) * 1000, 3)})
+
+        def log_message(self, fmt, *args):
+            print("[QUERY]", self.address_string(), fmt % args, file=sys.stderr)
+
+    return Handler
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765, db_path: Optional[str] = None):
+    q = CfeQuery(db_path)
+    server = ThreadingHTTPServer((host, port), _make_handler(q))
+    print(f"[INFO] CFE query API listening on http://{host}:{port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _print_rows(rows):
+    # stdout carries only the JSON result; diagnostics (config, logging) go to stderr
+    print(json.dumps(rows, indent=2, default=str))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.query", description="Query the local CFE store")
+    parser.add_argument("--db", default=None, help=f"SQLite store path (default: {config.STORE_PATH})")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_lookup = sub.add_parser("lookup", help="find a CFE by issuer, series and number")
+    p_lookup.add_argument("--emisor", required=True)
+    p_lookup.add_argument("--serie", required=True)
+    p_lookup.add_argument("--numero", required=True, type=int)
+    p_lookup.add_argument("--tipo", default=None)
+
+    p_totals = sub.add_parser("totals", help="precomputed totals per month / issuer")
+    p_totals.add_argument("--month", default=None, help="YYYY-MM")
+    p_totals.add_argument("--emisor", default=None)
+    p_totals.add_argument("--receptor", default=None)
+    p_totals.add_argument("--by", choices=["emisor", "month", "tipo"], default=None)
+
+    p_range = sub.add_parser("range", help="totals for an arbitrary date range")
+    p_range.add_argument("--from", dest="date_from", required=True, help="YYYY-MM-DD")
+    p_range.add_argument("--to", dest="date_to", required=True, help="YYYY-MM-DD")
+    p_range.add_argument("--emisor", default=None)
+    p_range.add_argument("--tipo", default=None)
+
+    p_serve = sub.add_parser("serve", help="run the JSON HTTP API")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=config.QUERY_HTTP_PORT)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "serve":
+        serve(args.host, args.port, db_path=args.db)
+        return
+
+    q = CfeQuery(args.db)
+    if args.cmd == "lookup":
+        _print_rows(q.lookup(args.emisor, args.serie, args.numero, tipo=args.tipo))
+    elif args.cmd == "totals":
+        _print_rows(q.totals(month=args.month, emisor=args.emisor, receptor=args.receptor, by=args.by))
+    elif args.cmd == "range":
+        _print_rows(q.range_totals(args.date_from, args.date_to, emisor=args.emisor, tipo=args.tipo))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+# src/scheduler.py
+"""
+Export scheduler: a persistent priority queue of export jobs with deadlines, plus a per-hour-of-day
+model of portal latency learned from past runs.
+
+Urgent jobs (current-month sync) always run on the next tick. Best-effort jobs (backfill) only run
+while the current hour is one of the portal's fast hours, unless waiting would miss their deadline.
+
+    python -m src.scheduler sync-current
+    python -m src.scheduler backfill --from-month 2024-01 --to-month 2025-05
+    python -m src.scheduler add --from 01/06/2025 --to 30/06/2025 --priority normal
+    python -m src.scheduler status
+    python -m src.scheduler run [--loop]
+"""
+import argparse
+import calendar
+import heapq
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from src import config
+from src.filelock import locked
+from src.concurrency import AdaptiveConcurrencyController
+from src.main import DATE_FMT, ExportJob, run_exports
+
+PRIORITIES = {"urgent": 0, "normal": 1, "backfill": 2}
+SESSION_STEPS = ("goto", "login", "consult", "export")
+
+
+class HourlyLatencyModel:
+    """EWMA of step latency (ms) and timeout rate per hour of day, persisted alongside the job queue."""
+
+    def __init__(self, data: Optional[dict] = None, alpha: float = 0.2):
+        self.alpha = alpha
+        # hours[str(hour)][step] = {"ewma_ms": float, "timeout_rate": float, "count": int}
+        self.hours: Dict[str, Dict[str, dict]] = (data or {}).get("hours", {})
+        self._lock = threading.Lock()
+
+    def observe(self, step: str, latency_ms: float, timed_out: bool = False, when: Optional[datetime] = None):
+        hour = str((when or datetime.now()).hour)
+        with self._lock:
+            s = self.hours.setdefault(hour, {}).setdefault(step, {"ewma_ms": latency_ms, "timeout_rate": 0.0, "count": 0})
+            s["ewma_ms"] = (1 - self.alpha) * s["ewma_ms"] + self.alpha * latency_ms
+            s["timeout_rate"] = (1 - self.alpha) * s["timeout_rate"] + self.alpha * (1.0 if timed_out else 0.0)
+            s["count"] += 1
+
+    def samples(self, hour: int) -> int:
+        steps = self.hours.get(str(hour), {})
+        return min((steps.get(name, {}).get("count", 0) for name in SESSION_STEPS), default=0)
+
+    def expected_session_ms(self, hour: int) -> Optional[float]:
+        """Expected login+consult+export time at this hour, or None when the hour has not been learned yet."""
+        if self.samples(hour) < config.SCHEDULER_MIN_SAMPLES:
+            return None
+        steps = self.hours[str(hour)]
+        total = sum(steps[name]["ewma_ms"] for name in SESSION_STEPS)
+        # a timeout costs a retry, so penalise hours that time out often
+        timeout_rate = max(steps[name]["timeout_rate"] for name in SESSION_STEPS)
+        return total * (1.0 + timeout_rate)
+
+    def fast_hours(self) -> List[int]:
+        """
+        Hours the portal is fast at. A learned hour is fast when at most SCHEDULER_FAST_QUANTILE of the
+        learned hours are as slow as it or faster, so slow hours that tie with each other never qualify;
+        the fastest learned hour always does. Unlearned hours only count as fast while nothing has been
+        learned yet (every hour runs until the model has data).
+
+        >>> m = HourlyLatencyModel()
+        >>> for hour, ms in ((3, 400), (14, 400000), (15, 400000), (16, 400000)):
+        ...     for _ in range(config.SCHEDULER_MIN_SAMPLES):
+        ...         for step in SESSION_STEPS:
+        ...             m.observe(step, ms, when=datetime(2025, 6, 2, hour))
+        >>> m.fast_hours()
+        [3]
+        """
+        learned = {h: self.expected_session_ms(h) for h in range(24)}
+        known = sorted(v for v in learned.values() if v is not None)
+        if not known:
+            return list(range(24))
+        fastest = known[0]
+        fast = []
+        for h, v in learned.items():
+            if v is None:
+                continue
+            at_or_below = sum(1 for k in known if k <= v)
+            if v == fastest or at_or_below <= len(known) * config.SCHEDULER_FAST_QUANTILE:
+                fast.append(h)
+        return fast
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"hours": json.loads(json.dumps(self.hours))}
+
+
+class ExportScheduler:
+    """
+    The state file is shared by every `python -m src.scheduler` process (a `run --loop` daemon plus
+    ad hoc `add`/`sync-current`/`backfill`), so every change is a load-modify-save cycle under an
+    exclusive lock on <state>.lock -- see transaction().
+    """
+
+    def __init__(self, state_path: Optional[str] = None):
+        self.state_path = Path(state_path or config.SCHEDULER_STATE_PATH)
+        self.lock_path = self.state_path.with_suffix(self.state_path.suffix + ".lock")
+        self.jobs: List[dict] = []
+        self.next_id = 1
+        self.latency = HourlyLatencyModel()
+        self._heap = []
+        # one controller for the life of the scheduler so the AIMD limit carries over between ticks
+        self.controller: Optional[AdaptiveConcurrencyController] = None
+        self._samples: List[tuple] = []
+        with locked(self.lock_path):
+            self._reload()
+
+    # ---------------------------
+    # Persistence
+    # ---------------------------
+
+    def _reload(self):
+        """Replace in-memory state with what is on disk (call with the lock held)."""
+        state = self._load()
+        self.jobs = state.get("jobs", [])
+        self.next_id = state.get("next_id", 1)
+        self.latency = HourlyLatencyModel(state.get("latency"))
+        stale_before = time.time() - config.SCHEDULER_STALE_RUNNING_HOURS * 3600
+        for job in self.jobs:
+            # a runner that died mid-batch leaves its jobs 'running'; give them back to the queue
+            if job["status"] == "running" and job.get("started_at", 0) < stale_before:
+                print(f"[SCHEDULER] Job {job['id']} was left running since {job.get('started_at')}; requeueing.")
+                job["status"] = "pending"
+        self._heap = [self._key(job) for job in self.jobs if job["status"] == "pending"]
+        heapq.heapify(self._heap)
+
+    @contextmanager
+    def transaction(self):
+        """Lock the state file, reload it, let the caller modify it, then save."""
+        with locked(self.lock_path):
+            self._reload()
+            yield self
+            self.save()
+
+    def _load(self) -> dict:
+        if not self.state_path.exists():
+            return {}
+        try:
+            return json.loads(self.state_path.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"[SCHEDULER] Could not read {self.state_path}, starting empty:", e)
+            return {}
+
+    def save(self):
+        state = {"next_id": self.next_id, "jobs": self.jobs, "latency": self.latency.to_dict()}
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_path.with_suffix(self.state_path.suffix + ".tmp")
+        tmp.write_text(json.dumps(state, indent=2), encoding="utf-8")
+        tmp.replace(self.state_path)
+
+    # ---------------------------
+    # Queue
+    # ---------------------------
+
+    @staticmethod
+    def _key(job: dict):
+        return (PRIORITIES[job["priority"]], job["deadline"], job["id"])
+
+    def add(self, date_from: str, date_to: str, tipo: Optional[str] = None, priority: str = "normal", deadline: Optional[float] = None) -> Optional[dict]:
+        """Queue a job. Call inside transaction() so the id and the job reach the shared state file."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {sorted(PRIORITIES)}")
+        tipo = tipo or config.ECF_TIPO
+        for job in self.jobs:
+            if job["status"] in ("pending", "running") and (job["tipo"], job["date_from"], job["date_to"]) == (tipo, date_from, date_to):
+                print(f"[SCHEDULER] Job {job['id']} already queued for {tipo} {date_from}..{date_to}")
+                return None
+        if deadline is None:
+            deadline = time.time() + config.SCHEDULER_DEFAULT_DEADLINE_HOURS[priority] * 3600
+        job = {
+            "id": self.next_id,
+            "tipo": tipo,
+            "date_from": date_from,
+            "date_to": date_to,
+            "priority": priority,
+            "deadline": deadline,
+            "attempts": 0,
+            "status": "pending",
+            "saved_path": None,
+        }
+        self.next_id += 1
+        self.jobs.append(job)
+        heapq.heappush(self._heap, self._key(job))
+        return job
+
+    def _by_id(self, job_id: int) -> Optional[dict]:
+        return next((j for j in self.jobs if j["id"] == job_id), None)
+
+    def _must_run_now(self, job: dict, now: datetime) -> bool:
+        """True if waiting for the next fast hour would make the job miss its deadline."""
+        expected_ms = self.latency.expected_session_ms(now.hour) or config.CONCURRENCY_TARGET_LATENCY_MS * len(SESSION_STEPS)
+        deadline = datetime.fromtimestamp(job["deadline"])
+        fast = set(self.latency.fast_hours())
+        slot = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        while slot + timedelta(milliseconds=expected_ms) < deadline:
+            if slot.hour in fast:
+                return False
+            slot += timedelta(hours=1)
+        return True
+
+    def select_batch(self, now: Optional[datetime] = None, limit: Optional[int] = None) -> List[dict]:
+        """Pop the jobs that should run in this tick, in priority/deadline order."""
+        now = now or datetime.now()
+        limit = limit or config.SCHEDULER_BATCH_SIZE
+        in_fast_window = now.hour in self.latency.fast_hours()
+        batch, deferred = [], []
+        while self._heap and len(batch) < limit:
+            key = heapq.heappop(self._heap)
+            job = self._by_id(key[2])
+            if job is None or job["status"] != "pending":
+                continue
+            if job["priority"] == "urgent" or in_fast_window or self._must_run_now(job, now):
+                batch.append(job)
+            else:
+                deferred.append(key)
+        for key in deferred:
+            heapq.heappush(self._heap, key)
+        return batch
+
+    # ---------------------------
+    # Execution
+    # ---------------------------
+
+    def _observe(self, step: str, latency_ms: float, timed_out: bool):
+        self._samples.append((step, latency_ms, timed_out, datetime.now()))
+
+    def _get_controller(self) -> AdaptiveConcurrencyController:
+        if self.controller is None:
+            self.controller = AdaptiveConcurrencyController(observer=self._observe)
+        return self.controller
+
+    def run_once(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now()
+        # claim the batch under the lock, run it without holding the lock, then record results under it
+        with self.transaction():
+            batch = self.select_batch(now)
+            for job in batch:
+                job["status"] = "running"
+                job["started_at"] = time.time()
+            batch_ids = [j["id"] for j in batch]
+            fast_hours = self.latency.fast_hours()
+        if not batch:
+            print(f"[SCHEDULER] Nothing to run at hour {now.hour} (fast hours: {fast_hours})")
+            return 0
+
+        print(f"[SCHEDULER] Running {len(batch)} job(s): {batch_ids}")
+        export_jobs = {j["id"]: ExportJob(j["tipo"], j["date_from"], j["date_to"]) for j in batch}
+        self._samples = samples = []
+        saved = {}
+        try:
+            for export_job, saved_path in run_exports(list(export_jobs.values()), controller=self._get_controller()):
+                saved[export_job] = saved_path
+        finally:
+            with self.transaction():
+                for step, ms, timed_out, when in samples:
+                    self.latency.observe(step, ms, timed_out, when=when)
+                for job_id in batch_ids:
+                    job = self._by_id(job_id)
+                    if job is None:
+                        continue
+                    # a job with no result at all (worker died, run_exports raised) counts as a failed attempt
+                    saved_path = saved.get(export_jobs[job_id])
+                    job["attempts"] += 1
+                    job.pop("started_at", None)
+                    if saved_path:
+                        job["status"] = "done"
+                        job["saved_path"] = saved_path
+                    elif job["attempts"] >= config.SCHEDULER_MAX_ATTEMPTS:
+                        job["status"] = "failed"
+                        print(f"[SCHEDULER] Job {job['id']} failed after {job['attempts']} attempts.")
+                    else:
+                        job["status"] = "pending"
+        return len(batch)
+
+    def run_forever(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print("[SCHEDULER] Tick failed:", e)
+            time.sleep(config.SCHEDULER_POLL_SECONDS)
+
+    def status(self) -> dict:
+        with locked(self.lock_path):
+            self._reload()
+        counts: Dict[str, int] = {}
+        for job in self.jobs:
+            counts[f"{job['priority']}/{job['status']}"] = counts.get(f"{job['priority']}/{job['status']}", 0) + 1
+        return {
+            "jobs": counts,
+            "fast_hours": self.latency.fast_hours(),
+            "expected_session_ms": {h: self.latency.expected_session_ms(h) for h in range(24)},
+        }
+
+
+def _month_bounds(year: int, month: int) -> Tuple[str, str]:
+    last = calendar.monthrange(year, month)[1]
+    return datetime(year, month, 1).strftime(DATE_FMT), datetime(year, month, last).strftime(DATE_FMT)
+
+
+def _parse_month(value: str):
+    year, month = value.split("-")
+    return int(year), int(month)
+
+
+def _queue_command(scheduler: "ExportScheduler", args):
+    if args.cmd == "add":
+        deadline = time.time() + args.deadline_hours * 3600 if args.deadline_hours is not None else None
+        job = scheduler.add(args.date_from, args.date_to, tipo=args.tipo, priority=args.priority, deadline=deadline)
+        if job:
+            print(f"[SCHEDULER] Queued job {job['id']}")
+    elif args.cmd == "sync-current":
+        today = datetime.now()
+        date_from = datetime(today.year, today.month, 1).strftime(DATE_FMT)
+        end_of_day = today.replace(hour=23, minute=59, second=59).timestamp()
+        job = scheduler.add(date_from, today.strftime(DATE_FMT), tipo=args.tipo, priority="urgent", deadline=end_of_day)
+        if job:
+            print(f"[SCHEDULER] Queued urgent job {job['id']} for {date_from}..{job['date_to']}")
+    elif args.cmd == "backfill":
+        year, month = _parse_month(args.from_month)
+        end = _parse_month(args.to_month)
+        queued = 0
+        while (year, month) <= end:
+            date_from, date_to = _month_bounds(year, month)
+            if scheduler.add(date_from, date_to, tipo=args.tipo, priority="backfill"):
+                queued += 1
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        print(f"[SCHEDULER] Queued {queued} backfill job(s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.scheduler", description="Prioritised, latency-aware export scheduler")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_add = sub.add_parser("add", help="queue one export window")
+    p_add.add_argument("--from", dest="date_from", required=True, help="DD/MM/YYYY")
+    p_add.add_argument("--to", dest="date_to", required=True, help="DD/MM/YYYY")
+    p_add.add_argument("--tipo", default=None)
+    p_add.add_argument("--priority", choices=sorted(PRIORITIES), default="normal")
+    p_add.add_argument("--deadline-hours", type=float, default=None)
+
+    p_sync = sub.add_parser("sync-current", help="queue an urgent sync of the current month")
+    p_sync.add_argument("--tipo", default=None)
+
+    p_back = sub.add_parser("backfill", help="queue best-effort monthly jobs for a range of months")
+    p_back.add_argument("--from-month", required=True, help="YYYY-MM")
+    p_back.add_argument("--to-month", required=True, help="YYYY-MM")
+    p_back.add_argument("--tipo", default=None)
+
+    sub.add_parser("status", help="show queue and learned latency")
+
+    p_run = sub.add_parser("run", help="run due jobs")
+    p_run.add_argument("--loop", action="store_true", help=f"keep running every SCHEDULER_POLL_SECONDS ({config.SCHEDULER_POLL_SECONDS}s)")
+
+    args = parser.parse_args(argv)
+    scheduler = ExportScheduler()
+
+    if args.cmd == "status":
+        print(json.dumps(scheduler.status(), indent=2))
+        return
+    if args.cmd == "run":
+        if args.loop:
+            scheduler.run_forever()
+        else:
+            scheduler.run_once()
+        return
+
+    with scheduler.transaction():
+        _queue_command(scheduler, args)
+
+
+if __name__ == "__main__":
+    main()
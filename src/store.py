@@ -0,0 +1,185 @@
+# src/store.py
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+from src import config
+from src.cfe_xls import CFE_FIELDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cfe (
+    rut_receptor TEXT NOT NULL,
+    fecha        TEXT NOT NULL,
+    tipo_cfe     TEXT NOT NULL,
+    serie        TEXT NOT NULL,
+    numero       INTEGER NOT NULL,
+    rut_emisor   TEXT NOT NULL,
+    moneda       TEXT,
+    monto_neto   REAL,
+    iva          REAL,
+    monto_total  REAL,
+    monto_ret    REAL,
+    monto_cred   REAL,
+    source_file  TEXT,
+    source_mtime REAL,
+    PRIMARY KEY (rut_receptor, rut_emisor, tipo_cfe, serie, numero)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS imported_files (
+    path         TEXT PRIMARY KEY,
+    size         INTEGER,
+    mtime        REAL,
+    rut_receptor TEXT,
+    period_from  TEXT,
+    period_to    TEXT,
+    rows         INTEGER,
+    imported_at  REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_cfe_emisor_serie_numero ON cfe (rut_emisor, serie, numero);
+CREATE INDEX IF NOT EXISTS idx_cfe_receptor_fecha ON cfe (rut_receptor, fecha);
+CREATE INDEX IF NOT EXISTS idx_cfe_tipo_fecha ON cfe (tipo_cfe, fecha);
+CREATE INDEX IF NOT EXISTS idx_cfe_fecha ON cfe (fecha);
+
+-- per receptor/month/issuer/tipo/currency totals, kept current by the triggers below.
+-- Amounts are integer cents so repeated add/subtract in the triggers never drifts.
+CREATE TABLE IF NOT EXISTS cfe_agg (
+    rut_receptor      TEXT NOT NULL,
+    month             TEXT NOT NULL,
+    rut_emisor        TEXT NOT NULL,
+    tipo_cfe          TEXT NOT NULL,
+    moneda            TEXT NOT NULL,
+    n                 INTEGER NOT NULL,
+    monto_neto_cents  INTEGER NOT NULL,
+    iva_cents         INTEGER NOT NULL,
+    monto_total_cents INTEGER NOT NULL,
+    PRIMARY KEY (rut_receptor, month, rut_emisor, tipo_cfe, moneda)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_cfe_agg_emisor ON cfe_agg (rut_emisor, month);
+
+CREATE TRIGGER IF NOT EXISTS trg_cfe_agg_insert AFTER INSERT ON cfe BEGIN
+    INSERT INTO cfe_agg VALUES (NEW.rut_receptor, substr(NEW.fecha, 1, 7), NEW.rut_emisor, NEW.tipo_cfe, COALESCE(NEW.moneda, ''),
+                                1, CAST(ROUND(NEW.monto_neto * 100) AS INTEGER), CAST(ROUND(NEW.iva * 100) AS INTEGER),
+                                CAST(ROUND(NEW.monto_total * 100) AS INTEGER))
+    ON CONFLICT DO UPDATE SET n = n + 1, monto_neto_cents = monto_neto_cents + excluded.monto_neto_cents,
+                              iva_cents = iva_cents + excluded.iva_cents, monto_total_cents = monto_total_cents + excluded.monto_total_cents;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_cfe_agg_delete AFTER DELETE ON cfe BEGIN
+    UPDATE cfe_agg SET n = n - 1, monto_neto_cents = monto_neto_cents - CAST(ROUND(OLD.monto_neto * 100) AS INTEGER),
+                       iva_cents = iva_cents - CAST(ROUND(OLD.iva * 100) AS INTEGER),
+                       monto_total_cents = monto_total_cents - CAST(ROUND(OLD.monto_total * 100) AS INTEGER)
+    WHERE rut_receptor = OLD.rut_receptor AND month = substr(OLD.fecha, 1, 7) AND rut_emisor = OLD.rut_emisor
+      AND tipo_cfe = OLD.tipo_cfe AND moneda = COALESCE(OLD.moneda, '');
+    DELETE FROM cfe_agg
+    WHERE n <= 0 AND rut_receptor = OLD.rut_receptor AND month = substr(OLD.fecha, 1, 7) AND rut_emisor = OLD.rut_emisor
+      AND tipo_cfe = OLD.tipo_cfe AND moneda = COALESCE(OLD.moneda, '');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_cfe_agg_update AFTER UPDATE OF fecha, moneda, monto_neto, iva, monto_total ON cfe BEGIN
+    UPDATE cfe_agg SET n = n - 1, monto_neto_cents = monto_neto_cents - CAST(ROUND(OLD.monto_neto * 100) AS INTEGER),
+                       iva_cents = iva_cents - CAST(ROUND(OLD.iva * 100) AS INTEGER),
+                       monto_total_cents = monto_total_cents - CAST(ROUND(OLD.monto_total * 100) AS INTEGER)
+    WHERE rut_receptor = OLD.rut_receptor AND month = substr(OLD.fecha, 1, 7) AND rut_emisor = OLD.rut_emisor
+      AND tipo_cfe = OLD.tipo_cfe AND moneda = COALESCE(OLD.moneda, '');
+    DELETE FROM cfe_agg
+    WHERE n <= 0 AND rut_receptor = OLD.rut_receptor AND month = substr(OLD.fecha, 1, 7) AND rut_emisor = OLD.rut_emisor
+      AND tipo_cfe = OLD.tipo_cfe AND moneda = COALESCE(OLD.moneda, '');
+    INSERT INTO cfe_agg VALUES (NEW.rut_receptor, substr(NEW.fecha, 1, 7), NEW.rut_emisor, NEW.tipo_cfe, COALESCE(NEW.moneda, ''),
+                                1, CAST(ROUND(NEW.monto_neto * 100) AS INTEGER), CAST(ROUND(NEW.iva * 100) AS INTEGER),
+                                CAST(ROUND(NEW.monto_total * 100) AS INTEGER))
+    ON CONFLICT DO UPDATE SET n = n + 1, monto_neto_cents = monto_neto_cents + excluded.monto_neto_cents,
+                              iva_cents = iva_cents + excluded.iva_cents, monto_total_cents = monto_total_cents + excluded.monto_total_cents;
+END;
+"""
+
+# source_mtime is the download time (file mtime) of the export a row was last written from
+CFE_SOURCE_COLUMNS = ("source_file", "source_mtime")
+CFE_COLUMNS = ("rut_receptor",) + CFE_FIELDS + CFE_SOURCE_COLUMNS
+CFE_KEY = ("rut_receptor", "rut_emisor", "tipo_cfe", "serie", "numero")
+CFE_VALUE_COLUMNS = tuple(c for c in CFE_COLUMNS if c not in CFE_KEY and c not in CFE_SOURCE_COLUMNS)
+# ON CONFLICT DO UPDATE (not INSERT OR REPLACE) so the cfe_agg triggers see a real UPDATE of existing rows;
+# rows re-seen with identical values (overlapping export windows) are left untouched
+UPSERT_CFE_SQL = (
+    f"INSERT INTO cfe ({', '.join(CFE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in CFE_COLUMNS)}) "
+    f"ON CONFLICT ({', '.join(CFE_KEY)}) DO UPDATE SET "
+    + ", ".join(f"{c} = excluded.{c}" for c in CFE_COLUMNS if c not in CFE_KEY)
+    + " WHERE (" + " OR ".join(f"cfe.{c} IS NOT excluded.{c}" for c in CFE_VALUE_COLUMNS) + ")"
+)
+# bulk imports of old files must not roll back a row last written from a more recent download
+UPSERT_CFE_IF_NEWER_SQL = UPSERT_CFE_SQL + " AND (cfe.source_mtime IS NULL OR excluded.source_mtime >= cfe.source_mtime)"
+
+
+def connect(db_path: Optional[str] = None, check_same_thread: bool = True) -> sqlite3.Connection:
+    """Open the local CFE store, creating the schema if needed."""
+    path = Path(db_path or config.STORE_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), timeout=30, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    cfe_columns = {row[1] for row in conn.execute("PRAGMA table_info(cfe)")}
+    if cfe_columns and "source_mtime" not in cfe_columns:
+        conn.execute("ALTER TABLE cfe ADD COLUMN source_mtime REAL")
+    agg_columns = {row[1] for row in conn.execute("PRAGMA table_info(cfe_agg)")}
+    if agg_columns and "monto_total_cents" not in agg_columns:
+        # stores created with REAL aggregate sums: drop them, they are rebuilt below
+        conn.executescript(
+            "DROP TRIGGER IF EXISTS trg_cfe_agg_insert; DROP TRIGGER IF EXISTS trg_cfe_agg_delete; "
+            "DROP TRIGGER IF EXISTS trg_cfe_agg_update; DROP TABLE cfe_agg;"
+        )
+    conn.executescript(SCHEMA)
+    if conn.execute("SELECT 1 FROM cfe_agg LIMIT 1").fetchone() is None and conn.execute("SELECT 1 FROM cfe LIMIT 1").fetchone():
+        rebuild_aggregates(conn)
+    return conn
+
+
+def rebuild_aggregates(conn: sqlite3.Connection):
+    """Recompute cfe_agg from scratch (stores created before the aggregate triggers or the cents columns existed)."""
+    with conn:
+        conn.execute("DELETE FROM cfe_agg")
+        conn.execute(
+            "INSERT INTO cfe_agg "
+            "SELECT rut_receptor, substr(fecha, 1, 7), rut_emisor, tipo_cfe, COALESCE(moneda, ''), "
+            "COUNT(*), SUM(CAST(ROUND(monto_neto * 100) AS INTEGER)), SUM(CAST(ROUND(iva * 100) AS INTEGER)), "
+            "SUM(CAST(ROUND(monto_total * 100) AS INTEGER)) "
+            "FROM cfe GROUP BY 1, 2, 3, 4, 5"
+        )
+
+
+def imported_checkpoints(conn: sqlite3.Connection) -> dict:
+    """{path: (size, mtime)} for every file already imported."""
+    return {path: (size, mtime) for path, size, mtime in conn.execute("SELECT path, size, mtime FROM imported_files")}
+
+
+def upsert_cfe_rows(conn: sqlite3.Connection, rows: Iterable[tuple], keep_newer: bool = False):
+    """
+    rows are tuples in CFE_COLUMNS order. With keep_newer, a stored row whose source_mtime is later than
+    the incoming one is left as it is.
+    """
+    conn.executemany(UPSERT_CFE_IF_NEWER_SQL if keep_newer else UPSERT_CFE_SQL, rows)
+
+
+def mark_cfe_source(conn: sqlite3.Connection, keys: Iterable[tuple], source_file: str, source_mtime: float):
+    """Record that rows (keys in CFE_KEY order) were re-seen unchanged in a more recent export."""
+    conn.executemany(
+        f"UPDATE cfe SET source_file = ?, source_mtime = ? WHERE {' AND '.join(f'{c} = ?' for c in CFE_KEY)} "
+        "AND (source_mtime IS NULL OR source_mtime < ?)",
+        ((source_file, source_mtime, *key, source_mtime) for key in keys),
+    )
+
+
+def delete_cfe_keys(conn: sqlite3.Connection, keys: Iterable[tuple]):
+    """keys are tuples in CFE_KEY order."""
+    conn.executemany(f"DELETE FROM cfe WHERE {' AND '.join(f'{c} = ?' for c in CFE_KEY)}", keys)
+
+
+def mark_imported(conn: sqlite3.Connection, path: str, size: int, mtime: float, rut: str, period_from: str, period_to: str, rows: int):
+    conn.execute(
+        "INSERT OR REPLACE INTO imported_files (path, size, mtime, rut_receptor, period_from, period_to, rows, imported_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (path, size, mtime, rut, period_from, period_to, rows, time.time()),
+    )